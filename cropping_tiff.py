@@ -1,74 +1,238 @@
 import os
-import random
-import tifffile as tiff
-import numpy as np
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import tifffile as tiff
+from tifffile import imwrite
+
+# Random generator used to place crop windows when no generator is passed in
+_RNG = np.random.default_rng()
 
-def crop_3d_image(image, crop_size):
+def _crop_extent(shape, crop_size, z_slices=8, enforce_min=None):
     """
-    Crop a 3D or 4D image in one go without looping through each Z-plane, including extracting the center 8 Z slices.
-    
+    Validate a crop against an image shape and work out its Z range and final size.
+
     Args:
-        image (numpy.ndarray): Input image, shape can be (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
+        shape (tuple): Image shape, (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
         crop_size (tuple): Desired crop dimensions as (crop_height, crop_width).
-        
+        z_slices (int, optional): Number of center Z slices to keep, 8 by default. None keeps all of them.
+        enforce_min (tuple, optional): Minimum (height, width) to grow the crop to, capped at the image size.
+
     Returns:
-        numpy.ndarray: Cropped image.
+        tuple: (z_start, z_end, crop_height, crop_width).
     """
     # Check image dimensions
-    if image.ndim not in [3, 4]:
+    if len(shape) not in [3, 4]:
         raise ValueError("Unsupported image dimensions. Expected 3D or 4D.")
     
     # Unpack crop dimensions
     crop_height, crop_width = crop_size
     
     # Get image dimensions
-    if image.ndim == 4:
-        z_dim, _, y_dim, x_dim = image.shape
-    elif image.ndim == 3:
-        z_dim, y_dim, x_dim = image.shape
+    if len(shape) == 4:
+        z_dim, _, y_dim, x_dim = shape
+    elif len(shape) == 3:
+        z_dim, y_dim, x_dim = shape
+
+    # Grow the crop to the minimum size without exceeding the image
+    if enforce_min is not None:
+        crop_height = min(max(enforce_min[0], crop_height), y_dim)
+        crop_width = min(max(enforce_min[1], crop_width), x_dim)
+
+    if z_slices is None:
+        z_slices = z_dim
 
     # Validate crop size
-    if y_dim < crop_height or x_dim < crop_width or z_dim < 10:
+    if y_dim < crop_height or x_dim < crop_width or z_dim < z_slices:
         raise ValueError("Crop size exceeds image dimensions or not enough Z slices.")
 
-    # Calculate the start and end indices to crop the center 8 Z slices
-    z_start = (z_dim - 10) // 2
-    z_end = z_start + 10
+    # Calculate the start and end indices to crop the center Z slices
+    z_start = (z_dim - z_slices) // 2
+    z_end = z_start + z_slices
+
+    return z_start, z_end, crop_height, crop_width
+
+
+def _crop_window(shape, crop_size, z_slices=8, enforce_min=None, rng=None):
+    """
+    Choose the crop window for an image of the given shape: the center Z slices and a random Y/X offset.
+
+    Args:
+        shape (tuple): Image shape, (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
+        crop_size (tuple): Desired crop dimensions as (crop_height, crop_width).
+        z_slices (int, optional): Number of center Z slices to keep, 8 by default. None keeps all of them.
+        enforce_min (tuple, optional): Minimum (height, width) to grow the crop to, capped at the image size.
+        rng (numpy.random.Generator, optional): Generator for the crop offsets. Defaults to the module generator.
+
+    Returns:
+        tuple: (z_start, z_end, y_start, x_start, crop_height, crop_width).
+    """
+    z_start, z_end, crop_height, crop_width = _crop_extent(shape, crop_size, z_slices, enforce_min)
+    if rng is None:
+        rng = _RNG
 
     # Randomly choose the starting indices for Y and X dimensions
-    y_start = np.random.randint(0, y_dim - crop_height + 1)
-    x_start = np.random.randint(0, x_dim - crop_width + 1)
+    y_start = int(rng.integers(0, shape[-2] - crop_height + 1))
+    x_start = int(rng.integers(0, shape[-1] - crop_width + 1))
+
+    return z_start, z_end, y_start, x_start, crop_height, crop_width
+
+
+def _window_slicer(ndim, z_start, z_end, y_start, x_start, crop_height, crop_width):
+    """
+    Build the index tuple selecting a crop window from a (Z, ..., Y, X) image with ndim dimensions.
+    """
+    z_sl = slice(z_start, z_end)
+    y_sl = slice(y_start, y_start + crop_height)
+    x_sl = slice(x_start, x_start + crop_width)
+    return (z_sl,) + (slice(None),) * (ndim - 3) + (y_sl, x_sl)
+
+
+def crop_3d_image(image, crop_size, *, z_slices=8, enforce_min=None, rng=None):
+    """
+    Crop a 3D or 4D image in one go without looping through each Z-plane, including extracting the center 8 Z slices by default.
     
-    # Crop the image
-    if image.ndim == 4:
-        cropped_image = image[z_start:z_end, :, y_start:y_start + crop_height, x_start:x_start + crop_width]
-    else:
-        cropped_image = image[z_start:z_end, y_start:y_start + crop_height, x_start:x_start + crop_width]
+    Args:
+        image (numpy.ndarray): Input image, shape can be (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
+        crop_size (tuple): Desired crop dimensions as (crop_height, crop_width).
+        z_slices (int, optional): Number of center Z slices to keep, 8 by default. None keeps all of them.
+        enforce_min (tuple, optional): Minimum (height, width) to grow the crop to, capped at the image size.
+        rng (numpy.random.Generator, optional): Generator for the crop offsets. Defaults to the module generator.
+        
+    Returns:
+        numpy.ndarray: Cropped image.
+    """
+    window = _crop_window(image.shape, crop_size, z_slices, enforce_min, rng)
     
-    return cropped_image
+    # Crop the image; slicing returns a view for both 3D and 4D inputs
+    return image[_window_slicer(image.ndim, *window)]
+
 
+def crop_3d_image_batch(image, crop_size, n, *, z_slices=8, enforce_min=None, rng=None):
+    """
+    Take n random crops of a 3D or 4D image in a single gather, for example to sample training patches.
 
+    Every Y/X window position is exposed as a strided view of the image, so the
+    n crops are gathered in one fancy-indexing step instead of n slicing calls.
+    All crops share the same center Z slices.
 
-from tifffile import imwrite
+    Args:
+        image (numpy.ndarray): Input image, shape can be (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
+        crop_size (tuple): Desired crop dimensions as (crop_height, crop_width).
+        n (int): Number of crops to take.
+        z_slices (int, optional): Number of center Z slices to keep, 8 by default. None keeps all of them.
+        enforce_min (tuple, optional): Minimum (height, width) to grow the crop to, capped at the image size.
+        rng (numpy.random.Generator, optional): Generator for the crop offsets. Defaults to the module generator.
+
+    Returns:
+        numpy.ndarray: Cropped images, shape (n, Z, [C,] crop_height, crop_width).
+    """
+    z_start, z_end, crop_height, crop_width = _crop_extent(image.shape, crop_size, z_slices, enforce_min)
+    image = image[z_start:z_end]
+    y_dim, x_dim = image.shape[-2:]
+    y_stride, x_stride = image.strides[-2:]
+
+    # windows[y, x] is the crop starting at (y, x); no data is copied here
+    windows = as_strided(
+        image,
+        shape=(y_dim - crop_height + 1, x_dim - crop_width + 1) + image.shape[:-2] + (crop_height, crop_width),
+        strides=(y_stride, x_stride) + image.strides[:-2] + (y_stride, x_stride),
+        writeable=False
+    )
+
+    if rng is None:
+        rng = _RNG
+    y_starts = rng.integers(0, y_dim - crop_height + 1, n)
+    x_starts = rng.integers(0, x_dim - crop_width + 1, n)
+    return np.ascontiguousarray(windows[y_starts, x_starts])
+
+
+def quantize_to_uint8(image, percentiles=(0.1, 99.9)):
+    """
+    Rescale a 3D or 4D image to uint8, stretching each channel between two intensity percentiles.
 
-def save_tiff_correctly(output_file, image):
+    Fluorescence data stored as uint16 often only fills 10-12 bits, so this halves
+    the output size while keeping most of the usable dynamic range. Values outside
+    the percentile range are clipped.
+
+    Args:
+        image (numpy.ndarray): Input image, shape can be (Z, C, Y, X) for 4D or (Z, Y, X) for 3D.
+        percentiles (tuple, optional): Lower and upper percentiles mapped to 0 and 255.
+
+    Returns:
+        tuple: (quantized image, per-channel lower bounds, per-channel upper bounds).
+        The bounds have one entry per channel (a single entry for 3D images), so
+        ``lo + quantized * (hi - lo) / 255`` approximately restores the original values.
+    """
+    # Reduce over everything but the channel axis
+    axis = (0, 2, 3) if image.ndim == 4 else None
+    lo, hi = np.percentile(image, percentiles, axis=axis, keepdims=True)
+
+    # Flat channels map to zero instead of dividing by zero
+    span = np.where(hi > lo, hi - lo, 1.0)
+    scaled = np.subtract(image, lo, dtype=np.float32)
+    np.multiply(scaled, (255.0 / span).astype(np.float32), out=scaled)
+    np.clip(scaled, 0, 255, out=scaled)
+    np.rint(scaled, out=scaled)
+    return scaled.astype(np.uint8), lo.ravel(), hi.ravel()
+
+
+def save_tiff_correctly(output_file, image, *, imagej=True, rescale=None):
     """
     Saves a multi-channel TIFF correctly, ensuring compatibility with ImageJ,
     formatted for non-color channel data like fluorescence markers,
     adding placeholder dimensions for T (time) and S (samples) if necessary.
 
+    With imagej=False the image is written as a plain tiled TIFF instead,
+    which ImageJ only opens through Bio-Formats.
+
     Args:
         output_file (str): Path to the output TIFF file.
-        image (numpy.ndarray): Cropped image array, expected to have dimensions (Z, C, Y, X).
+        image (numpy.ndarray): Cropped image array, expected to have dimensions (Z, C, Y, X) or (Z, Y, X).
+        imagej (bool, optional): Write an ImageJ hyperstack. Defaults to True.
+        rescale (tuple, optional): Per-channel (lo, hi) bounds from quantize_to_uint8,
+            stored as rescale_min/rescale_max metadata so the scaling can be undone.
+            ImageJ metadata keeps them as JSON list text, plain output as JSON lists.
     """
+    metadata = {}
+    if rescale is not None:
+        metadata['rescale_min'] = [float(v) for v in rescale[0]]
+        metadata['rescale_max'] = [float(v) for v in rescale[1]]
+
+    if not imagej:
+        # Zstd compresses better and faster than deflate, and tiles let
+        # readers crop the output without decoding all of it. Float data gets
+        # no predictor, as the floating-point predictor needs imagecodecs.
+        imwrite(
+            output_file,
+            image,
+            photometric='minisblack',
+            metadata={'axes': 'ZCYX' if image.ndim == 4 else 'ZYX', **metadata},
+            compression='zstd',
+            compressionargs={'level': 1},
+            predictor=image.dtype.kind in 'iu',
+            tile=(256, 256)
+        )
+        print(f"Saved: {output_file} with shape {image.shape}")
+        return
+
+    # Reshaping a C-contiguous array is free, and tifffile can write it
+    # without an intermediate copy
+    image = np.ascontiguousarray(image)
+
+    # A 3D stack is a hyperstack with a single channel
+    if image.ndim == 3:  # Z, Y, X
+        image = image.reshape(image.shape[0], 1, *image.shape[1:])
+
     # Check if we need to add placeholders for T and S
     if image.ndim == 4:  # Z, C, Y, X
         # Add a singleton dimension for T at the start and S at the end (1, Z, C, Y, X, 1)
-        image = np.expand_dims(image, axis=0)  # Add T dimension at the start
-        image = np.expand_dims(image, axis=-1)  # Add S dimension at the end
+        image = image.reshape(1, *image.shape, 1)
 
     # Format the description for ImageJ
     imagej_description = (
@@ -80,29 +244,331 @@ def save_tiff_correctly(output_file, image):
         )
     )
 
-    # Save the entire image using tifffile
+    # Save the entire image using tifffile. Deflate with a horizontal predictor
+    # is the strongest lossless compression ImageJ opens without Bio-Formats.
+    # ImageJ cannot decode the floating-point predictor, so float data is
+    # deflated without one.
     imwrite(
         output_file,
         image,
         photometric='minisblack',
-        metadata={'axes': 'TZCYXS'},
-        imagej=imagej_description
+        metadata={'axes': 'TZCYXS', **metadata},
+        imagej=imagej_description,
+        compression='zlib',
+        compressionargs={'level': 1},
+        predictor=image.dtype.kind in 'iu'
     )
     print(f"Saved: {output_file} with shape {image.shape}")
 
 
-from pathlib import Path
-import os
-import tifffile as tiff
+# Threads each worker process uses to decode compressed segments. Kept small
+# because files are already spread across one process per core.
+DECODE_WORKERS = 2
+
+# Cropped files each worker keeps queued for its writer thread while it reads
+# the next file.
+MAX_PENDING_WRITES = 2
+
+# Flat scratch arrays each worker process copies crop windows into, one per
+# slot so a window is not overwritten while its write is pending. Grown as
+# needed and reused across files instead of allocating a fresh array per file.
+_scratch = [None] * MAX_PENDING_WRITES
 
-def process_folder(input_folder, output_folder, crop_size):
+
+def _get_buffer(shape, dtype, slot=0):
+    """
+    Return a C-contiguous array of the given shape and dtype backed by one of the worker's scratch buffers.
+
+    The contents are only valid until the next call for the same slot, which may reuse the same memory.
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    scratch = _scratch[slot]
+    if scratch is None or scratch.dtype != dtype or scratch.size < size:
+        scratch = _scratch[slot] = np.empty(size, dtype=dtype)
+    return scratch[:size].reshape(shape)
+
+
+def _read_tiles(tif, series, z_start, z_end, y_start, x_start, crop_height, crop_width, slot=0):
+    """
+    Read a crop window from a tiled TIFF series, decoding only the tiles that intersect it.
+
+    Args:
+        tif (tifffile.TiffFile): Open TIFF file.
+        series (tifffile.TiffPageSeries): Series of 2D tiled planes, (Z, C, Y, X) or (Z, Y, X).
+        z_start (int): First Z slice of the window.
+        z_end (int): End (exclusive) Z slice of the window.
+        y_start (int): First row of the window.
+        x_start (int): First column of the window.
+        crop_height (int): Height of the window.
+        crop_width (int): Width of the window.
+        slot (int, optional): Scratch buffer to decode into.
+
+    Returns:
+        numpy.ndarray: Cropped image, shape (z_end - z_start, [C,] crop_height, crop_width),
+        held in the worker's scratch buffer.
+    """
+    keyframe = series.keyframe
+    y_dim, x_dim = series.shape[-2:]
+    tile_height, tile_width = keyframe.tilelength, keyframe.tilewidth
+    tiles_down = -(-y_dim // tile_height)
+    tiles_across = -(-x_dim // tile_width)
+    # Planes per page are the separate samples of a planar configuration
+    planes_per_page = int(np.prod(keyframe.shape[:-2]))
+    planes_per_z = int(np.prod(series.shape[1:-2]))
+
+    out_shape = (z_end - z_start,) + series.shape[1:-2] + (crop_height, crop_width)
+    out = _get_buffer(out_shape, series.dtype, slot)
+    out_planes = out.reshape(-1, crop_height, crop_width)
+
+    # Range of tile rows and columns overlapping the window
+    ty0, ty1 = y_start // tile_height, (y_start + crop_height - 1) // tile_height
+    tx0, tx1 = x_start // tile_width, (x_start + crop_width - 1) // tile_width
+
+    fh = tif.filehandle
+    decode = keyframe.decode
+    for out_index, plane in enumerate(range(z_start * planes_per_z, z_end * planes_per_z)):
+        page = series.pages[plane // planes_per_page]
+        sample = plane % planes_per_page
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                index = (sample * tiles_down + ty) * tiles_across + tx
+
+                # Intersection of this tile with the window, in image coordinates
+                y0 = max(ty * tile_height, y_start)
+                y1 = min((ty + 1) * tile_height, y_start + crop_height, y_dim)
+                x0 = max(tx * tile_width, x_start)
+                x1 = min((tx + 1) * tile_width, x_start + crop_width, x_dim)
+                target = out_planes[out_index, y0 - y_start:y1 - y_start, x0 - x_start:x1 - x_start]
+
+                # Sparse files may omit tiles; readers fill them with nodata
+                if page.databytecounts[index] == 0:
+                    target[...] = keyframe.nodata or 0
+                    continue
+
+                fh.seek(page.dataoffsets[index])
+                data = fh.read(page.databytecounts[index])
+                tile = decode(data, index, jpegtables=keyframe.jpegtables)[0]
+                tile = tile.reshape(tile.shape[-3], tile.shape[-2])
+                target[...] = tile[y0 - ty * tile_height:y1 - ty * tile_height,
+                                   x0 - tx * tile_width:x1 - tx * tile_width]
+
+    return out
+
+
+def _is_tile_readable(series):
+    """
+    Check whether a series can be cropped with _read_tiles: tiled 2D planes, one page per plane or planar samples.
+    """
+    keyframe = series.keyframe
+    if not keyframe.is_tiled or len(series.shape) not in [3, 4]:
+        return False
+    # shaped is (separate samples, depth, length, width, contiguous samples)
+    if keyframe.shaped[1] != 1 or keyframe.shaped[-1] != 1:
+        return False
+    if keyframe.shape[-2:] != series.shape[-2:]:
+        return False
+    planes_per_page = int(np.prod(keyframe.shape[:-2]))
+    return len(series.pages) * planes_per_page == int(np.prod(series.shape[:-2]))
+
+
+def _read_z_slices(tif, series, z_start, z_end):
+    """
+    Decode only the pages holding Z slices z_start to z_end of a series.
+
+    Falls back to decoding the whole series when its pages do not split evenly along Z.
+
+    Args:
+        tif (tifffile.TiffFile): Open TIFF file.
+        series (tifffile.TiffPageSeries): Series of shape (Z, C, Y, X) or (Z, Y, X).
+        z_start (int): First Z slice to read.
+        z_end (int): End (exclusive) Z slice to read.
+
+    Returns:
+        numpy.ndarray: Image of shape (z_end - z_start, [C,] Y, X).
+    """
+    shape = series.shape
+    num_pages = len(series.pages)
+    page_size = int(np.prod(series.keyframe.shape))
+    if num_pages % shape[0] or num_pages * page_size != int(np.prod(shape)):
+        return series.asarray(maxworkers=DECODE_WORKERS)[z_start:z_end]
+
+    pages_per_z = num_pages // shape[0]
+    pages = tif.asarray(key=range(z_start * pages_per_z, z_end * pages_per_z),
+                        series=0, maxworkers=DECODE_WORKERS)
+    return pages.reshape((z_end - z_start,) + shape[1:])
+
+
+def _read_crop(fh, file_name, crop_size, z_slices, enforce_min, slot=0, rng=None):
+    """
+    Choose a crop window for an open TIFF file and read only that window.
+
+    Args:
+        fh (file): Input TIFF opened in binary mode.
+        file_name (str): Name of the input file, for messages.
+        crop_size (tuple): (height, width).
+        z_slices (int): Number of center Z slices to keep, or None for all.
+        enforce_min (tuple): Minimum (height, width) of the crop, or None.
+        slot (int, optional): Scratch buffer to copy the window into.
+        rng (numpy.random.Generator, optional): Generator for the crop offsets. Defaults to the module generator.
+
+    Returns:
+        numpy.ndarray: Cropped image held in the worker's scratch buffer, or None
+        if the image dimensions are unsupported.
+    """
+    with tiff.TiffFile(fh) as tif:
+        series = tif.series[0]
+        shape = series.shape
+
+        # Skip unsupported image dimensions
+        if len(shape) not in [3, 4]:
+            print(f"Skipping {file_name}: Unsupported dimensions {shape}")
+            return None
+
+        # Choose the window from the shape alone, then read only that window
+        window = _crop_window(shape, crop_size, z_slices, enforce_min, rng)
+        z_start, z_end, y_start, x_start, crop_height, crop_width = window
+
+        if _is_tile_readable(series):
+            # Decode only the tiles intersecting the window
+            return _read_tiles(tif, series, z_start, z_end, y_start, x_start,
+                               crop_height, crop_width, slot)
+
+        if series.dataoffset is not None:
+            # Map the image so slicing only pages in the window
+            image = np.memmap(fh, dtype=tif.byteorder + series.dtype.char, mode='r',
+                              offset=series.dataoffset, shape=shape)
+        else:
+            # Decode only the pages of the Z slices we keep
+            image = _read_z_slices(tif, series, z_start, z_end)
+            z_start, z_end = 0, z_end - z_start
+
+        # Copy the window into the scratch buffer, then drop every reference
+        # to the image so a memory map is closed right away
+        slicer = _window_slicer(image.ndim, z_start, z_end, y_start, x_start,
+                                crop_height, crop_width)
+        view = image[slicer]
+        cropped_image = _get_buffer(view.shape, view.dtype, slot)
+        np.copyto(cropped_image, view)
+        del view, image
+        return cropped_image
+
+
+def _process_one(input_file, output_file, crop_size, z_slices, enforce_min, imagej, quantize,
+                 writer, slot, rng):
+    """
+    Crop a single 3D/4D TIFF image and queue it to be saved correctly.
+
+    Args:
+        input_file (str): Path to the input TIFF image.
+        output_file (str): Path to the output TIFF file.
+        crop_size (tuple): (height, width).
+        z_slices (int): Number of center Z slices to keep, or None for all.
+        enforce_min (tuple): Minimum (height, width) of the crop, or None.
+        imagej (bool): Write an ImageJ hyperstack rather than a plain tiled TIFF.
+        quantize (bool): Rescale the crop to uint8 before writing.
+        writer (concurrent.futures.Executor): Executor the write is submitted to.
+        slot (int): Scratch buffer to crop into; must not be used by a pending write.
+        rng (numpy.random.Generator): Generator for the crop offsets.
+
+    Returns:
+        concurrent.futures.Future: The pending write, or None if the file was skipped or failed.
+    """
+    file_name = os.path.basename(input_file)
+    try:
+        with open(input_file, 'rb') as fh:
+            try:
+                cropped_image = _read_crop(fh, file_name, crop_size, z_slices, enforce_min, slot, rng)
+            finally:
+                # The input is never read again, so drop it from the page cache
+                # instead of letting it evict pages that are still useful
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        if cropped_image is None:
+            return None
+
+        # Optionally trade precision for half the output size
+        rescale = None
+        if quantize:
+            cropped_image, lo, hi = quantize_to_uint8(cropped_image)
+            rescale = (lo, hi)
+
+        # Save while ensuring proper Z-stack and channel recombination
+        return writer.submit(save_tiff_correctly, output_file, cropped_image,
+                             imagej=imagej, rescale=rescale)
+    except Exception as e:
+        print(f"Error processing {file_name}: {e}")
+        return None
+
+
+def _finish_write(future, input_file, output_file):
+    """
+    Wait for a write queued by _process_one and report how it went.
+    """
+    try:
+        future.result()
+        print(f"Processed and saved: {output_file}")
+    except Exception as e:
+        print(f"Error processing {os.path.basename(input_file)}: {e}")
+
+
+def _process_batch(files, crop_size, z_slices, enforce_min, imagej, quantize):
+    """
+    Crop a batch of 3D/4D TIFF images in one worker process, writing each one on a
+    background thread while the next one is read.
+
+    Args:
+        files (list): (input_file, output_file, seed) triples, where seed seeds the
+            generator for that file's crop offsets.
+        crop_size (tuple): (height, width).
+        z_slices (int): Number of center Z slices to keep, or None for all.
+        enforce_min (tuple): Minimum (height, width) of the crop, or None.
+        imagej (bool): Write ImageJ hyperstacks rather than plain tiled TIFFs.
+        quantize (bool): Rescale each crop to uint8 before writing.
+    """
+    pending = deque()
+    # Counts queued writes, so the next slot is the one used MAX_PENDING_WRITES
+    # writes ago. A skipped file queues nothing and its slot is used again.
+    queued = 0
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        for input_file, output_file, seed in files:
+            # Bound the queued writes; this also frees the slot we crop into next
+            if len(pending) == MAX_PENDING_WRITES:
+                _finish_write(*pending.popleft())
+
+            future = _process_one(input_file, output_file, crop_size, z_slices, enforce_min,
+                                  imagej, quantize, writer, queued % MAX_PENDING_WRITES,
+                                  np.random.default_rng(seed))
+            if future is not None:
+                pending.append((future, input_file, output_file))
+                queued += 1
+
+        while pending:
+            _finish_write(*pending.popleft())
+
+
+def process_folder(input_folder, output_folder, crop_size, max_workers=None, *,
+                   z_slices=8, enforce_min=(300, 300), imagej=True, quantize=False, seed=None):
     """
     Process all 3D/4D TIFF images in the input folder, crop them, and save them correctly.
 
+    Files are independent, so they are cropped in parallel worker processes, each
+    of which writes its output on a background thread while reading the next file.
+
     Args:
         input_folder (str): Path to input folder containing TIFF images.
         output_folder (str): Path to output folder to save cropped images.
         crop_size (tuple): (height, width).
+        max_workers (int, optional): Number of worker processes. Defaults to os.cpu_count(),
+            capped at 61 on Windows.
+        z_slices (int, optional): Number of center Z slices to keep, 8 by default. None keeps all of them.
+        enforce_min (tuple, optional): Minimum (height, width) of the crop, capped at the image size.
+        imagej (bool, optional): Write ImageJ hyperstacks rather than plain tiled TIFFs.
+        quantize (bool, optional): Rescale each crop to uint8 between its 0.1 and 99.9
+            intensity percentiles. Lossy, so off by default.
+        seed (int, optional): Seed for the crop offsets. The same seed, files and options
+            give the same crops regardless of max_workers. None draws fresh entropy.
     """
     input_path = Path(input_folder)
     output_path = Path(output_folder)
@@ -110,34 +576,35 @@ def process_folder(input_folder, output_folder, crop_size):
     if not output_path.exists():
         output_path.mkdir(parents=True, exist_ok=True)
 
-    for file_name in os.listdir(input_path):
-        if file_name.endswith('.tif') or file_name.endswith('.tiff'):
-            input_file = input_path / file_name
-            output_file_name = f"{input_file.stem}_cropped{input_file.suffix}"
-            output_file = output_path / output_file_name
-            
-            try:
-                # Load the TIFF image
-                image = tiff.imread(input_file)
-                
-                # Skip unsupported image dimensions
-                if image.ndim not in [3, 4]:
-                    print(f"Skipping {file_name}: Unsupported dimensions {image.shape}")
-                    continue
-
-                # Ensure the crop size does not exceed the image dimensions
-                crop_height = min(max(300, crop_size[0]), image.shape[-2])
-                crop_width = min(max(300, crop_size[1]), image.shape[-1])
+    files = []
+    with os.scandir(input_path) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(('.tif', '.tiff')):
+                stem, suffix = os.path.splitext(entry.name)
+                output_file = os.path.join(output_path, f"{stem}_cropped{suffix}")
+                files.append((entry.path, output_file))
 
-                # Crop the image
-                cropped_image = crop_3d_image(image, (crop_height, crop_width))
+    # Every file gets its own child seed, so its crop does not depend on which
+    # worker or batch it lands in. Sorting keeps the file-to-seed mapping stable.
+    files.sort()
+    seeds = np.random.SeedSequence(seed).spawn(len(files))
+    files = [(input_file, output_file, file_seed)
+             for (input_file, output_file), file_seed in zip(files, seeds)]
 
-                # Save while ensuring proper Z-stack and channel recombination
-                save_tiff_correctly(output_file, cropped_image)
+    # Give every worker about four batches, so the load stays balanced while
+    # each batch is long enough for reads and writes to overlap
+    if not max_workers:
+        max_workers = os.cpu_count()
+        # ProcessPoolExecutor rejects more than 61 workers on Windows
+        if sys.platform == 'win32':
+            max_workers = min(max_workers, 61)
+    batch_size = max(1, -(-len(files) // (max_workers * 4)))
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
 
-                print(f"Processed and saved: {output_file}")
-            except Exception as e:
-                print(f"Error processing {file_name}: {e}")
+    worker = partial(_process_batch, crop_size=crop_size, z_slices=z_slices,
+                     enforce_min=enforce_min, imagej=imagej, quantize=quantize)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(worker, batches))
 
 
 if __name__ == "__main__":
@@ -146,4 +613,5 @@ if __name__ == "__main__":
     output_folder = "D:/annotations_for_MBL/dapi/rna_scope/round2/cropped_outdir"
     crop_height, crop_width = 350, 350  # Ensuring at least 300x300 but within image limits
 
-    process_folder(input_folder, output_folder, (crop_height, crop_width))
+    process_folder(input_folder, output_folder, (crop_height, crop_width),
+                   z_slices=8, enforce_min=(300, 300), imagej=True)
@@ -0,0 +1,258 @@
+import importlib.util
+import json
+import time
+
+import numpy as np
+import pytest
+import tifffile as tiff
+
+import cropping_tiff
+
+needs_imagecodecs = pytest.mark.skipif(
+    importlib.util.find_spec('imagecodecs') is None,
+    reason="compression codec requires imagecodecs"
+)
+
+# Shapes whose Y/X sizes are not multiples of the 64 px tiles, so edge tiles are exercised
+SHAPE_4D = (10, 3, 300, 260)
+SHAPE_3D = (11, 300, 260)
+
+# name: (shape, dtype, imwrite kwargs, expected read path). A 'sparse' kwarg
+# removes every n-th tile of each page after writing.
+LAYOUTS = {
+    'tiled-planar-zlib': (SHAPE_4D, np.uint16,
+                          dict(tile=(64, 64), compression='zlib', metadata={'axes': 'ZCYX'}), 'tiles'),
+    'tiled-3d-zlib': (SHAPE_3D, np.uint8, dict(tile=(64, 64), compression='zlib'), 'tiles'),
+    'tiled-bigendian': (SHAPE_4D, np.uint16,
+                        dict(tile=(64, 64), byteorder='>', metadata={'axes': 'ZCYX'}), 'tiles'),
+    'tiled-zstd': pytest.param((SHAPE_4D, np.uint16,
+                                dict(tile=(64, 64), compression='zstd', metadata={'axes': 'ZCYX'}),
+                                'tiles'), marks=needs_imagecodecs),
+    'tiled-lzw-predictor': pytest.param((SHAPE_3D, np.uint16,
+                                         dict(tile=(64, 64), compression='lzw', predictor=True),
+                                         'tiles'), marks=needs_imagecodecs),
+    'tiled-sparse-zlib': (SHAPE_4D, np.uint16,
+                          dict(tile=(64, 64), compression='zlib', metadata={'axes': 'ZCYX'}, sparse=3),
+                          'tiles'),
+    'imagej-memmap': (SHAPE_4D, np.uint16, dict(imagej=True, metadata={'axes': 'ZCYX'}), 'memmap'),
+    'plain-memmap': (SHAPE_3D, np.float32, dict(), 'memmap'),
+    'bigendian-memmap': (SHAPE_4D, np.uint16,
+                         dict(byteorder='>', metadata={'axes': 'ZCYX'}), 'memmap'),
+    'strips-zlib': (SHAPE_4D, np.uint16, dict(compression='zlib', metadata={'axes': 'ZCYX'}), 'pages'),
+}
+
+
+def _write_layout(path, shape, dtype, kwargs):
+    kwargs = dict(kwargs)
+    sparse = kwargs.pop('sparse', None)
+    rng = np.random.default_rng(0)
+    image = (rng.random(shape) * 4000).astype(dtype)
+    tiff.imwrite(path, image, photometric='minisblack', **kwargs)
+
+    if sparse:
+        # Zero offset and byte count mark a tile as absent
+        with tiff.TiffFile(path, mode='r+b') as tif:
+            for page in tif.pages:
+                offsets = list(page.dataoffsets)
+                bytecounts = list(page.databytecounts)
+                offsets[::sparse] = [0] * len(offsets[::sparse])
+                bytecounts[::sparse] = [0] * len(bytecounts[::sparse])
+                page.tags['TileOffsets'].overwrite(offsets)
+                page.tags['TileByteCounts'].overwrite(bytecounts)
+
+    return tiff.imread(path)
+
+
+def _read_path(path):
+    with tiff.TiffFile(path) as tif:
+        series = tif.series[0]
+        if cropping_tiff._is_tile_readable(series):
+            return 'tiles'
+        return 'memmap' if series.dataoffset is not None else 'pages'
+
+
+@pytest.mark.parametrize('crop_size', [(120, 100), (300, 260)])
+@pytest.mark.parametrize('layout', list(LAYOUTS.values()), ids=list(LAYOUTS))
+def test_read_crop_matches_crop_3d_image(tmp_path, layout, crop_size):
+    shape, dtype, kwargs, expected_path = layout
+    path = tmp_path / 'image.tif'
+    full = _write_layout(path, shape, dtype, kwargs)
+    assert _read_path(path) == expected_path
+
+    with open(path, 'rb') as fh:
+        cropped = cropping_tiff._read_crop(fh, path.name, crop_size, 8, None,
+                                           rng=np.random.default_rng(1))
+    expected = cropping_tiff.crop_3d_image(full, crop_size, rng=np.random.default_rng(1))
+
+    assert cropped.shape == expected.shape
+    np.testing.assert_array_equal(cropped, expected)
+
+
+def test_read_crop_skips_unsupported_dimensions(tmp_path):
+    path = tmp_path / 'image.tif'
+    tiff.imwrite(path, np.zeros((64, 64), dtype=np.uint8))
+
+    with open(path, 'rb') as fh:
+        assert cropping_tiff._read_crop(fh, path.name, (32, 32), 8, None) is None
+
+
+def test_process_batch_skipped_file_does_not_reuse_pending_slot(tmp_path, monkeypatch):
+    # A file that fails to crop must not hand its slot to the next file while
+    # an earlier write into that slot is still queued
+    rng = np.random.default_rng(0)
+    inputs = {}
+    for name, z_dim in [('a', 10), ('b', 3), ('c', 10)]:
+        image = rng.integers(0, 4000, (z_dim, 2, 64, 64), dtype=np.uint16)
+        path = tmp_path / f'{name}.tif'
+        tiff.imwrite(path, image, imagej=True, metadata={'axes': 'ZCYX'})
+        inputs[name] = image
+
+    save_tiff_correctly = cropping_tiff.save_tiff_correctly
+
+    def slow_save(*args, **kwargs):
+        time.sleep(0.2)
+        save_tiff_correctly(*args, **kwargs)
+
+    monkeypatch.setattr(cropping_tiff, 'save_tiff_correctly', slow_save)
+
+    files = [(str(tmp_path / f'{name}.tif'), str(tmp_path / f'{name}_cropped.tif'), seed)
+             for seed, name in enumerate('abc')]
+    cropping_tiff._process_batch(files, (32, 32), 8, None, imagej=True, quantize=False)
+
+    assert not (tmp_path / 'b_cropped.tif').exists()
+    for seed, name in [(0, 'a'), (2, 'c')]:
+        expected = cropping_tiff.crop_3d_image(inputs[name], (32, 32), rng=np.random.default_rng(seed))
+        np.testing.assert_array_equal(tiff.imread(tmp_path / f'{name}_cropped.tif'), expected)
+
+
+@pytest.mark.parametrize('imagej', [True, pytest.param(False, marks=needs_imagecodecs)])
+@pytest.mark.parametrize('dtype, predictor', [(np.uint16, 2), (np.float32, 1)])
+def test_save_tiff_correctly_round_trip(tmp_path, imagej, dtype, predictor):
+    image = (np.random.default_rng(0).random((8, 2, 40, 30)) * 4000).astype(dtype)
+    path = tmp_path / 'out.tif'
+    cropping_tiff.save_tiff_correctly(path, image, imagej=imagej)
+
+    with tiff.TiffFile(path) as tif:
+        # Float data must not use the floating-point predictor, which needs imagecodecs
+        assert tif.pages[0].predictor == predictor
+        np.testing.assert_array_equal(tif.asarray(), image)
+
+
+@pytest.mark.parametrize('image', [
+    np.arange(12 * 50 * 40, dtype=np.uint16).reshape(12, 50, 40),
+    np.arange(12 * 3 * 50 * 40, dtype=np.uint16).reshape(12, 3, 50, 40),
+    # Non-C-contiguous inputs: a Fortran-ordered array and a strided view
+    np.asfortranarray(np.arange(12 * 3 * 50 * 40, dtype=np.int32).reshape(12, 3, 50, 40)),
+    np.arange(12 * 4 * 100 * 90, dtype=np.float32).reshape(12, 4, 100, 90)[:, ::2, ::2, 1::2],
+], ids=['3d', '4d', '4d-fortran', '4d-strided-view'])
+def test_crop_3d_image_batch_matches_slicing(image):
+    crop_height, crop_width, n = 20, 15, 9
+    batch = cropping_tiff.crop_3d_image_batch(image, (crop_height, crop_width), n,
+                                              rng=np.random.default_rng(7))
+
+    # Draw the offsets the same way crop_3d_image_batch does
+    rng = np.random.default_rng(7)
+    y_starts = rng.integers(0, image.shape[-2] - crop_height + 1, n)
+    x_starts = rng.integers(0, image.shape[-1] - crop_width + 1, n)
+    z_start = (image.shape[0] - 8) // 2
+
+    assert batch.shape == (n, 8) + image.shape[1:-2] + (crop_height, crop_width)
+    for crop, y, x in zip(batch, y_starts, x_starts):
+        expected = image[z_start:z_start + 8, ..., y:y + crop_height, x:x + crop_width]
+        np.testing.assert_array_equal(crop, expected)
+
+
+def test_quantize_to_uint8_per_channel_bounds_and_restore():
+    rng = np.random.default_rng(0)
+    image = np.stack([rng.integers(100, 1100, (8, 30, 30)),
+                      rng.integers(2000, 4000, (8, 30, 30))], axis=1).astype(np.uint16)
+
+    quantized, lo, hi = cropping_tiff.quantize_to_uint8(image)
+
+    assert quantized.dtype == np.uint8 and quantized.shape == image.shape
+    for c in range(image.shape[1]):
+        expected_lo, expected_hi = np.percentile(image[:, c], (0.1, 99.9))
+        assert lo[c] == pytest.approx(expected_lo)
+        assert hi[c] == pytest.approx(expected_hi)
+
+        # Inside the percentile range the docstring's formula restores values
+        # to within one quantization step
+        restored = lo[c] + quantized[:, c] * (hi[c] - lo[c]) / 255
+        inside = (image[:, c] >= lo[c]) & (image[:, c] <= hi[c])
+        step = (hi[c] - lo[c]) / 255
+        assert np.all(np.abs(restored[inside] - image[:, c][inside]) <= step)
+
+
+def test_quantize_to_uint8_flat_channel_maps_to_zero():
+    image = np.zeros((8, 2, 10, 10), dtype=np.uint16)
+    image[:, 0] = 500
+    image[:, 1] = np.arange(100).reshape(10, 10)
+
+    quantized, lo, hi = cropping_tiff.quantize_to_uint8(image)
+
+    assert lo[0] == hi[0] == 500
+    assert not quantized[:, 0].any()
+    assert quantized[:, 1].max() == 255
+
+
+@pytest.mark.parametrize('imagej', [True, pytest.param(False, marks=needs_imagecodecs)])
+def test_save_tiff_correctly_stores_rescale_bounds(tmp_path, imagej):
+    image = np.random.default_rng(0).integers(0, 4000, (8, 2, 20, 20), dtype=np.uint16)
+    quantized, lo, hi = cropping_tiff.quantize_to_uint8(image)
+    path = tmp_path / 'out.tif'
+    cropping_tiff.save_tiff_correctly(path, quantized, imagej=imagej, rescale=(lo, hi))
+
+    with tiff.TiffFile(path) as tif:
+        if imagej:
+            # ImageJ descriptions only hold text, so the lists come back as JSON
+            rescale_min = json.loads(tif.imagej_metadata['rescale_min'])
+            rescale_max = json.loads(tif.imagej_metadata['rescale_max'])
+        else:
+            rescale_min = tif.shaped_metadata[0]['rescale_min']
+            rescale_max = tif.shaped_metadata[0]['rescale_max']
+        np.testing.assert_allclose(rescale_min, lo)
+        np.testing.assert_allclose(rescale_max, hi)
+        np.testing.assert_array_equal(tif.asarray(), quantized)
+
+
+def test_process_folder_seed_is_independent_of_max_workers(tmp_path):
+    input_folder = tmp_path / 'in'
+    input_folder.mkdir()
+    rng = np.random.default_rng(0)
+    names = [f'image{i}.tif' for i in range(5)]
+    for name in names:
+        image = rng.integers(0, 4000, (10, 2, 80, 70), dtype=np.uint16)
+        tiff.imwrite(input_folder / name, image, imagej=True, metadata={'axes': 'ZCYX'})
+
+    for max_workers in (1, 2):
+        cropping_tiff.process_folder(input_folder, tmp_path / f'out{max_workers}', (30, 20),
+                                     max_workers, enforce_min=None, seed=1234)
+
+    for name in names:
+        output_name = name.replace('.tif', '_cropped.tif')
+        np.testing.assert_array_equal(tiff.imread(tmp_path / 'out1' / output_name),
+                                      tiff.imread(tmp_path / 'out2' / output_name))
+
+
+def test_process_folder_caps_default_workers_on_windows(tmp_path, monkeypatch):
+    created = {}
+
+    class RecordingExecutor:
+        def __init__(self, max_workers):
+            created['max_workers'] = max_workers
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def map(self, fn, iterable):
+            return map(fn, iterable)
+
+    monkeypatch.setattr(cropping_tiff.sys, 'platform', 'win32')
+    monkeypatch.setattr(cropping_tiff.os, 'cpu_count', lambda: 128)
+    monkeypatch.setattr(cropping_tiff, 'ProcessPoolExecutor', RecordingExecutor)
+    cropping_tiff.process_folder(tmp_path, tmp_path / 'out', (32, 32))
+
+    assert created['max_workers'] == 61